@@ -12,16 +12,42 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import itertools
+import functools
+import string
 import urllib.parse
-from typing import Dict, List, Optional, Tuple
+from typing import List, Optional, Tuple
+from unittest.mock import Mock
 
-from synapse.api.constants import EventTypes, RelationTypes
+from synapse.api.constants import EventTypes, Membership, RelationTypes
+from synapse.push.action_generator import ActionGenerator
 from synapse.rest import admin
 from synapse.rest.client import login, register, relations, room
+from synapse.types import JsonDict
 
 from tests import unittest
 from tests.server import FakeChannel
+from tests.test_utils import event_injection, simple_async_mock
+
+RELATIONS_URL = "/_matrix/client/unstable/rooms/%s/relations/%s"
+AGGREGATIONS_URL = "/_matrix/client/unstable/rooms/%s/aggregations/%s"
+AGGREGATIONS_BY_RELATION_URL = "/_matrix/client/unstable/rooms/%s/aggregations/%s/%s"
+AGGREGATIONS_BY_KEY_URL = "/_matrix/client/unstable/rooms/%s/aggregations/%s/%s/%s/%s"
+SEND_RELATION_URL = "/_matrix/client/unstable/rooms/%s/send_relation/%s/%s/%s%s"
+
+# The fixed fields of the latest event bundled into a thread summary, when the
+# thread summary is fetched straight after sending an `m.room.test` thread event.
+# The per-test fields (IDs, sender and timestamp) are filled in by the test.
+THREAD_LATEST_EVENT_TEMPLATE = {
+    "age": 100,
+    "type": "m.room.test",
+    "unsigned": {"age": 100},
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _quote_key(key: str) -> str:
+    """URL-encode an annotation key, for use in a path or query string."""
+    return urllib.parse.quote_plus(key.encode("utf-8"))
 
 
 class RelationsTestCase(unittest.HomeserverTestCase):
@@ -39,37 +65,51 @@ class RelationsTestCase(unittest.HomeserverTestCase):
         config = super().default_config()
         config["experimental_msc1849_support_enabled"] = True
 
-        # We enable frozen dicts as relations/edits change event contents, so we
-        # want to test that we don't modify the events in the caches.
-        config["use_frozen_dicts"] = True
+        # Tests which fetch events with bundled aggregations or edits enable
+        # `use_frozen_dicts` via `override_config`, as relations/edits change event
+        # contents and we want to test that we don't modify the events in the
+        # caches. The other tests don't need to pay for freezing every event.
 
         return config
 
+    def make_homeserver(self, reactor, clock):
+        # Relations don't depend on push rules, so don't bother evaluating them
+        # for every event we send. (Federation sending is already disabled by
+        # the default test config.)
+        action_generator = Mock(spec=ActionGenerator)
+        action_generator.handle_push_actions_for_event = simple_async_mock()
+
+        return self.setup_test_homeserver(action_generator=action_generator)
+
     def prepare(self, reactor, clock, hs):
         self.user_id, self.user_token = self._create_user("alice")
         self.user2_id, self.user2_token = self._create_user("bob")
 
         self.room = self.helper.create_room_as(self.user_id, tok=self.user_token)
-        self.helper.join(self.room, user=self.user2_id, tok=self.user2_token)
+
+        self._join_room(self.user2_id)
         res = self.helper.send(self.room, body="Hi!", tok=self.user_token)
         self.parent_id = res["event_id"]
 
+    @unittest.override_config({"use_frozen_dicts": True})
     def test_send_relation(self):
         """Tests that sending a relation using the new /send_relation works
         creates the right shape of event.
         """
 
         channel = self._send_relation(RelationTypes.ANNOTATION, "m.reaction", key="👍")
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
-        event_id = channel.json_body["event_id"]
+        event_id = body["event_id"]
 
         channel = self.make_request(
             "GET",
             "/rooms/%s/event/%s" % (self.room, event_id),
             access_token=self.user_token,
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
         self.assert_dict(
             {
@@ -83,13 +123,14 @@ class RelationsTestCase(unittest.HomeserverTestCase):
                     }
                 },
             },
-            channel.json_body,
+            body,
         )
 
     def test_deny_membership(self):
         """Test that we deny relations on membership events"""
         channel = self._send_relation(RelationTypes.ANNOTATION, EventTypes.Member)
-        self.assertEquals(400, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(400, channel.code, body)
 
     def test_deny_invalid_event(self):
         """Test that we deny relations on non-existant events"""
@@ -99,7 +140,8 @@ class RelationsTestCase(unittest.HomeserverTestCase):
             parent_id="foo",
             content={"body": "foo", "msgtype": "m.text"},
         )
-        self.assertEquals(400, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(400, channel.code, body)
 
         # Unless that event is referenced from another event!
         self.get_success(
@@ -119,7 +161,8 @@ class RelationsTestCase(unittest.HomeserverTestCase):
             parent_id="foo",
             content={"body": "foo", "msgtype": "m.text"},
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
     def test_deny_invalid_room(self):
         """Test that we deny relations on non-existant events"""
@@ -132,15 +175,18 @@ class RelationsTestCase(unittest.HomeserverTestCase):
         channel = self._send_relation(
             RelationTypes.ANNOTATION, "m.reaction", parent_id=parent_id, key="A"
         )
-        self.assertEquals(400, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(400, channel.code, body)
 
     def test_deny_double_react(self):
         """Test that we deny relations on membership events"""
         channel = self._send_relation(RelationTypes.ANNOTATION, "m.reaction", key="a")
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
         channel = self._send_relation(RelationTypes.ANNOTATION, "m.reaction", "a")
-        self.assertEquals(400, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(400, channel.code, body)
 
     def test_deny_forked_thread(self):
         """It is invalid to start a thread off a thread."""
@@ -150,8 +196,9 @@ class RelationsTestCase(unittest.HomeserverTestCase):
             content={"msgtype": "m.text", "body": "foo"},
             parent_id=self.parent_id,
         )
-        self.assertEquals(200, channel.code, channel.json_body)
-        parent_id = channel.json_body["event_id"]
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
+        parent_id = body["event_id"]
 
         channel = self._send_relation(
             RelationTypes.THREAD,
@@ -159,43 +206,42 @@ class RelationsTestCase(unittest.HomeserverTestCase):
             content={"msgtype": "m.text", "body": "foo"},
             parent_id=parent_id,
         )
-        self.assertEquals(400, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(400, channel.code, body)
 
     def test_basic_paginate_relations(self):
         """Tests that calling pagination API correctly the latest relations."""
         channel = self._send_relation(RelationTypes.ANNOTATION, "m.reaction", "a")
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
         channel = self._send_relation(RelationTypes.ANNOTATION, "m.reaction", "b")
-        self.assertEquals(200, channel.code, channel.json_body)
-        annotation_id = channel.json_body["event_id"]
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
+        annotation_id = body["event_id"]
 
         channel = self.make_request(
             "GET",
-            "/_matrix/client/unstable/rooms/%s/relations/%s?limit=1"
-            % (self.room, self.parent_id),
+            RELATIONS_URL % (self.room, self.parent_id) + "?limit=1",
             access_token=self.user_token,
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
         # We expect to get back a single pagination result, which is the full
         # relation event we sent above.
-        self.assertEquals(len(channel.json_body["chunk"]), 1, channel.json_body)
+        self.assertEqual(len(body["chunk"]), 1, body)
         self.assert_dict(
             {"event_id": annotation_id, "sender": self.user_id, "type": "m.reaction"},
-            channel.json_body["chunk"][0],
+            body["chunk"][0],
         )
 
         # We also expect to get the original event (the id of which is self.parent_id)
-        self.assertEquals(
-            channel.json_body["original_event"]["event_id"], self.parent_id
-        )
+        self.assertEqual(body["original_event"]["event_id"], self.parent_id)
 
         # Make sure next_batch has something in it that looks like it could be a
         # valid token.
-        self.assertIsInstance(
-            channel.json_body.get("next_batch"), str, channel.json_body
-        )
+        self.assertIsInstance(body.get("next_batch"), str, body)
 
     def test_repeated_paginate_relations(self):
         """Test that if we paginate using a limit and tokens then we get the
@@ -203,200 +249,121 @@ class RelationsTestCase(unittest.HomeserverTestCase):
         """
 
         expected_event_ids = []
-        for idx in range(10):
-            channel = self._send_relation(
-                RelationTypes.ANNOTATION, "m.reaction", chr(ord("a") + idx)
-            )
-            self.assertEquals(200, channel.code, channel.json_body)
-            expected_event_ids.append(channel.json_body["event_id"])
+        for key in string.ascii_lowercase[:10]:
+            channel = self._send_relation(RelationTypes.ANNOTATION, "m.reaction", key)
+            body = channel.json_body
+            self.assertEqual(200, channel.code, body)
+            expected_event_ids.append(body["event_id"])
 
-        prev_token: Optional[str] = None
-        found_event_ids: List[str] = []
-        for _ in range(20):
-            from_token = ""
-            if prev_token:
-                from_token = "&from=" + prev_token
+        # We paginate backwards, so reverse
+        expected_event_ids.reverse()
 
-            channel = self.make_request(
-                "GET",
-                "/_matrix/client/unstable/rooms/%s/relations/%s?limit=1%s"
-                % (self.room, self.parent_id, from_token),
-                access_token=self.user_token,
-            )
-            self.assertEquals(200, channel.code, channel.json_body)
+        url = RELATIONS_URL % (self.room, self.parent_id)
 
-            found_event_ids.extend(e["event_id"] for e in channel.json_body["chunk"])
-            next_batch = channel.json_body.get("next_batch")
-
-            self.assertNotEquals(prev_token, next_batch)
-            prev_token = next_batch
-
-            if not prev_token:
-                break
-
-        # We paginated backwards, so reverse
-        found_event_ids.reverse()
-        self.assertEquals(found_event_ids, expected_event_ids)
+        # Fetch a few at a time, to check that the pagination tokens work.
+        found_event_ids = [e["event_id"] for e in self._paginate_all(url, limit=3)]
+        self.assertEqual(found_event_ids, expected_event_ids)
 
     def test_aggregation_pagination_groups(self):
         """Test that we can paginate annotation groups correctly."""
 
         # We need to create ten separate users to send each reaction.
         access_tokens = [self.user_token, self.user2_token]
-        idx = 0
-        while len(access_tokens) < 10:
-            user_id, token = self._create_user("test" + str(idx))
-            idx += 1
-
-            self.helper.join(self.room, user=user_id, tok=token)
-            access_tokens.append(token)
+        access_tokens.extend(self._create_room_members(8))
 
-        idx = 0
         sent_groups = {"👍": 10, "a": 7, "b": 5, "c": 3, "d": 2, "e": 1}
-        for key in itertools.chain.from_iterable(
-            itertools.repeat(key, num) for key, num in sent_groups.items()
-        ):
+        keys = [key for key, num in sent_groups.items() for _ in range(num)]
+
+        # Cycle through the users, so that no user sends the same key twice.
+        for idx, key in enumerate(keys):
             channel = self._send_relation(
                 RelationTypes.ANNOTATION,
                 "m.reaction",
                 key=key,
-                access_token=access_tokens[idx],
-            )
-            self.assertEquals(200, channel.code, channel.json_body)
-
-            idx += 1
-            idx %= len(access_tokens)
-
-        prev_token: Optional[str] = None
-        found_groups: Dict[str, int] = {}
-        for _ in range(20):
-            from_token = ""
-            if prev_token:
-                from_token = "&from=" + prev_token
-
-            channel = self.make_request(
-                "GET",
-                "/_matrix/client/unstable/rooms/%s/aggregations/%s?limit=1%s"
-                % (self.room, self.parent_id, from_token),
-                access_token=self.user_token,
+                access_token=access_tokens[idx % len(access_tokens)],
             )
-            self.assertEquals(200, channel.code, channel.json_body)
-
-            self.assertEqual(len(channel.json_body["chunk"]), 1, channel.json_body)
+            body = channel.json_body
+            self.assertEqual(200, channel.code, body)
 
-            for groups in channel.json_body["chunk"]:
-                # We only expect reactions
-                self.assertEqual(groups["type"], "m.reaction", channel.json_body)
+        url = AGGREGATIONS_URL % (self.room, self.parent_id)
 
-                # We should only see each key once
-                self.assertNotIn(groups["key"], found_groups, channel.json_body)
+        # Fetch a few at a time, to check that the pagination tokens work.
+        found_groups: List[Tuple[str, int]] = []
+        for groups in self._paginate_all(url, limit=2):
+            # We only expect reactions
+            self.assertEqual(groups["type"], "m.reaction", groups)
 
-                found_groups[groups["key"]] = groups["count"]
+            found_groups.append((groups["key"], groups["count"]))
 
-            next_batch = channel.json_body.get("next_batch")
-
-            self.assertNotEquals(prev_token, next_batch)
-            prev_token = next_batch
-
-            if not prev_token:
-                break
-
-        self.assertEquals(sent_groups, found_groups)
+        # We should see each key exactly once, with the most popular first.
+        self.assertEqual(found_groups, list(sent_groups.items()))
 
     def test_aggregation_pagination_within_group(self):
         """Test that we can paginate within an annotation group."""
 
         # We need to create ten separate users to send each reaction.
         access_tokens = [self.user_token, self.user2_token]
-        idx = 0
-        while len(access_tokens) < 10:
-            user_id, token = self._create_user("test" + str(idx))
-            idx += 1
-
-            self.helper.join(self.room, user=user_id, tok=token)
-            access_tokens.append(token)
+        access_tokens.extend(self._create_room_members(8))
 
-        idx = 0
         expected_event_ids = []
-        for _ in range(10):
+        for access_token in access_tokens:
             channel = self._send_relation(
                 RelationTypes.ANNOTATION,
                 "m.reaction",
                 key="👍",
-                access_token=access_tokens[idx],
+                access_token=access_token,
             )
-            self.assertEquals(200, channel.code, channel.json_body)
-            expected_event_ids.append(channel.json_body["event_id"])
-
-            idx += 1
+            body = channel.json_body
+            self.assertEqual(200, channel.code, body)
+            expected_event_ids.append(body["event_id"])
 
         # Also send a different type of reaction so that we test we don't see it
         channel = self._send_relation(RelationTypes.ANNOTATION, "m.reaction", key="a")
-        self.assertEquals(200, channel.code, channel.json_body)
-
-        prev_token: Optional[str] = None
-        found_event_ids: List[str] = []
-        encoded_key = urllib.parse.quote_plus("👍".encode())
-        for _ in range(20):
-            from_token = ""
-            if prev_token:
-                from_token = "&from=" + prev_token
-
-            channel = self.make_request(
-                "GET",
-                "/_matrix/client/unstable/rooms/%s"
-                "/aggregations/%s/%s/m.reaction/%s?limit=1%s"
-                % (
-                    self.room,
-                    self.parent_id,
-                    RelationTypes.ANNOTATION,
-                    encoded_key,
-                    from_token,
-                ),
-                access_token=self.user_token,
-            )
-            self.assertEquals(200, channel.code, channel.json_body)
-
-            self.assertEqual(len(channel.json_body["chunk"]), 1, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
-            found_event_ids.extend(e["event_id"] for e in channel.json_body["chunk"])
+        # We paginate backwards, so reverse
+        expected_event_ids.reverse()
 
-            next_batch = channel.json_body.get("next_batch")
-
-            self.assertNotEquals(prev_token, next_batch)
-            prev_token = next_batch
-
-            if not prev_token:
-                break
+        url = AGGREGATIONS_BY_KEY_URL % (
+            self.room,
+            self.parent_id,
+            RelationTypes.ANNOTATION,
+            "m.reaction",
+            _quote_key("👍"),
+        )
 
-        # We paginated backwards, so reverse
-        found_event_ids.reverse()
-        self.assertEquals(found_event_ids, expected_event_ids)
+        # Fetch a few at a time, to check that the pagination tokens work.
+        found_event_ids = [e["event_id"] for e in self._paginate_all(url, limit=3)]
+        self.assertEqual(found_event_ids, expected_event_ids)
 
     def test_aggregation(self):
         """Test that annotations get correctly aggregated."""
 
         channel = self._send_relation(RelationTypes.ANNOTATION, "m.reaction", "a")
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
         channel = self._send_relation(
             RelationTypes.ANNOTATION, "m.reaction", "a", access_token=self.user2_token
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
         channel = self._send_relation(RelationTypes.ANNOTATION, "m.reaction", "b")
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
         channel = self.make_request(
             "GET",
-            "/_matrix/client/unstable/rooms/%s/aggregations/%s"
-            % (self.room, self.parent_id),
+            AGGREGATIONS_URL % (self.room, self.parent_id),
             access_token=self.user_token,
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
-        self.assertEquals(
-            channel.json_body,
+        self.assertEqual(
+            body,
             {
                 "chunk": [
                     {"type": "m.reaction", "key": "a", "count": 2},
@@ -409,13 +376,15 @@ class RelationsTestCase(unittest.HomeserverTestCase):
         """Test that annotations get correctly aggregated after a redaction."""
 
         channel = self._send_relation(RelationTypes.ANNOTATION, "m.reaction", "a")
-        self.assertEquals(200, channel.code, channel.json_body)
-        to_redact_event_id = channel.json_body["event_id"]
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
+        to_redact_event_id = body["event_id"]
 
         channel = self._send_relation(
             RelationTypes.ANNOTATION, "m.reaction", "a", access_token=self.user2_token
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
         # Now lets redact one of the 'a' reactions
         channel = self.make_request(
@@ -424,73 +393,81 @@ class RelationsTestCase(unittest.HomeserverTestCase):
             access_token=self.user_token,
             content={},
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
         channel = self.make_request(
             "GET",
-            "/_matrix/client/unstable/rooms/%s/aggregations/%s"
-            % (self.room, self.parent_id),
+            AGGREGATIONS_URL % (self.room, self.parent_id),
             access_token=self.user_token,
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
-        self.assertEquals(
-            channel.json_body,
+        self.assertEqual(
+            body,
             {"chunk": [{"type": "m.reaction", "key": "a", "count": 1}]},
         )
 
     def test_aggregation_must_be_annotation(self):
         """Test that aggregations must be annotations."""
 
+        url = AGGREGATIONS_BY_RELATION_URL % (
+            self.room,
+            self.parent_id,
+            RelationTypes.REPLACE,
+        )
         channel = self.make_request(
-            "GET",
-            "/_matrix/client/unstable/rooms/%s/aggregations/%s/%s?limit=1"
-            % (self.room, self.parent_id, RelationTypes.REPLACE),
-            access_token=self.user_token,
+            "GET", url + "?limit=1", access_token=self.user_token
         )
-        self.assertEquals(400, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(400, channel.code, body)
 
-    @unittest.override_config({"experimental_features": {"msc3440_enabled": True}})
+    @unittest.override_config(
+        {
+            "experimental_features": {"msc3440_enabled": True},
+            "use_frozen_dicts": True,
+        }
+    )
     def test_aggregation_get_event(self):
         """Test that annotations, references, and threads get correctly bundled when
         getting the parent event.
         """
 
-        channel = self._send_relation(RelationTypes.ANNOTATION, "m.reaction", "a")
-        self.assertEquals(200, channel.code, channel.json_body)
-
-        channel = self._send_relation(
-            RelationTypes.ANNOTATION, "m.reaction", "a", access_token=self.user2_token
+        # Sending relations is tested elsewhere, so persist the annotations and
+        # references directly.
+        self._inject_relation(RelationTypes.ANNOTATION, "m.reaction", "a")
+        self._inject_relation(
+            RelationTypes.ANNOTATION, "m.reaction", "a", sender=self.user2_id
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        self._inject_relation(RelationTypes.ANNOTATION, "m.reaction", "b")
 
-        channel = self._send_relation(RelationTypes.ANNOTATION, "m.reaction", "b")
-        self.assertEquals(200, channel.code, channel.json_body)
-
-        channel = self._send_relation(RelationTypes.REFERENCE, "m.room.test")
-        self.assertEquals(200, channel.code, channel.json_body)
-        reply_1 = channel.json_body["event_id"]
-
-        channel = self._send_relation(RelationTypes.REFERENCE, "m.room.test")
-        self.assertEquals(200, channel.code, channel.json_body)
-        reply_2 = channel.json_body["event_id"]
+        reply_1 = self._inject_relation(RelationTypes.REFERENCE, "m.room.test")
+        reply_2 = self._inject_relation(RelationTypes.REFERENCE, "m.room.test")
 
         channel = self._send_relation(RelationTypes.THREAD, "m.room.test")
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
         channel = self._send_relation(RelationTypes.THREAD, "m.room.test")
-        self.assertEquals(200, channel.code, channel.json_body)
-        thread_2 = channel.json_body["event_id"]
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
+        thread_2 = body["event_id"]
+
+        # The timestamp of the thread event depends on how long the test setup
+        # took, so look it up rather than hardcoding it.
+        thread_2_event = self.get_success(self.hs.get_datastore().get_event(thread_2))
 
         channel = self.make_request(
             "GET",
             "/rooms/%s/event/%s" % (self.room, self.parent_id),
             access_token=self.user_token,
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
-        self.assertEquals(
-            channel.json_body["unsigned"].get("m.relations"),
+        self.assertEqual(
+            body["unsigned"].get("m.relations"),
             {
                 RelationTypes.ANNOTATION: {
                     "chunk": [
@@ -504,7 +481,7 @@ class RelationsTestCase(unittest.HomeserverTestCase):
                 RelationTypes.THREAD: {
                     "count": 2,
                     "latest_event": {
-                        "age": 100,
+                        **THREAD_LATEST_EVENT_TEMPLATE,
                         "content": {
                             "m.relates_to": {
                                 "event_id": self.parent_id,
@@ -512,17 +489,16 @@ class RelationsTestCase(unittest.HomeserverTestCase):
                             }
                         },
                         "event_id": thread_2,
-                        "origin_server_ts": 1600,
+                        "origin_server_ts": thread_2_event.origin_server_ts,
                         "room_id": self.room,
                         "sender": self.user_id,
-                        "type": "m.room.test",
-                        "unsigned": {"age": 100},
                         "user_id": self.user_id,
                     },
                 },
             },
         )
 
+    @unittest.override_config({"use_frozen_dicts": True})
     def test_edit(self):
         """Test that a simple edit works."""
 
@@ -532,20 +508,16 @@ class RelationsTestCase(unittest.HomeserverTestCase):
             "m.room.message",
             content={"msgtype": "m.text", "body": "foo", "m.new_content": new_body},
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
-        edit_event_id = channel.json_body["event_id"]
+        edit_event_id = body["event_id"]
 
-        channel = self.make_request(
-            "GET",
-            "/rooms/%s/event/%s" % (self.room, self.parent_id),
-            access_token=self.user_token,
-        )
-        self.assertEquals(200, channel.code, channel.json_body)
+        event_dict = self._get_event_direct(self.parent_id)
 
-        self.assertEquals(channel.json_body["content"], new_body)
+        self.assertEqual(event_dict["content"], new_body)
 
-        relations_dict = channel.json_body["unsigned"].get("m.relations")
+        relations_dict = event_dict["unsigned"].get("m.relations")
         self.assertIn(RelationTypes.REPLACE, relations_dict)
 
         m_replace_dict = relations_dict[RelationTypes.REPLACE]
@@ -556,6 +528,7 @@ class RelationsTestCase(unittest.HomeserverTestCase):
             {"event_id": edit_event_id, "sender": self.user_id}, m_replace_dict
         )
 
+    @unittest.override_config({"use_frozen_dicts": True})
     def test_multi_edit(self):
         """Test that multiple edits, including attempts by people who
         shouldn't be allowed, are correctly handled.
@@ -570,7 +543,8 @@ class RelationsTestCase(unittest.HomeserverTestCase):
                 "m.new_content": {"msgtype": "m.text", "body": "First edit"},
             },
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
         new_body = {"msgtype": "m.text", "body": "I've been edited!"}
         channel = self._send_relation(
@@ -578,9 +552,10 @@ class RelationsTestCase(unittest.HomeserverTestCase):
             "m.room.message",
             content={"msgtype": "m.text", "body": "foo", "m.new_content": new_body},
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
-        edit_event_id = channel.json_body["event_id"]
+        edit_event_id = body["event_id"]
 
         channel = self._send_relation(
             RelationTypes.REPLACE,
@@ -591,18 +566,14 @@ class RelationsTestCase(unittest.HomeserverTestCase):
                 "m.new_content": {"msgtype": "m.text", "body": "Edit, but wrong type"},
             },
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
-        channel = self.make_request(
-            "GET",
-            "/rooms/%s/event/%s" % (self.room, self.parent_id),
-            access_token=self.user_token,
-        )
-        self.assertEquals(200, channel.code, channel.json_body)
+        event_dict = self._get_event_direct(self.parent_id)
 
-        self.assertEquals(channel.json_body["content"], new_body)
+        self.assertEqual(event_dict["content"], new_body)
 
-        relations_dict = channel.json_body["unsigned"].get("m.relations")
+        relations_dict = event_dict["unsigned"].get("m.relations")
         self.assertIn(RelationTypes.REPLACE, relations_dict)
 
         m_replace_dict = relations_dict[RelationTypes.REPLACE]
@@ -613,6 +584,7 @@ class RelationsTestCase(unittest.HomeserverTestCase):
             {"event_id": edit_event_id, "sender": self.user_id}, m_replace_dict
         )
 
+    @unittest.override_config({"use_frozen_dicts": True})
     def test_edit_reply(self):
         """Test that editing a reply works."""
 
@@ -622,8 +594,9 @@ class RelationsTestCase(unittest.HomeserverTestCase):
             "m.room.message",
             content={"msgtype": "m.text", "body": "A reply!"},
         )
-        self.assertEquals(200, channel.code, channel.json_body)
-        reply = channel.json_body["event_id"]
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
+        reply = body["event_id"]
 
         new_body = {"msgtype": "m.text", "body": "I've been edited!"}
         channel = self._send_relation(
@@ -632,20 +605,16 @@ class RelationsTestCase(unittest.HomeserverTestCase):
             content={"msgtype": "m.text", "body": "foo", "m.new_content": new_body},
             parent_id=reply,
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
-        edit_event_id = channel.json_body["event_id"]
+        edit_event_id = body["event_id"]
 
-        channel = self.make_request(
-            "GET",
-            "/rooms/%s/event/%s" % (self.room, reply),
-            access_token=self.user_token,
-        )
-        self.assertEquals(200, channel.code, channel.json_body)
+        event_dict = self._get_event_direct(reply)
 
         # We expect to see the new body in the dict, as well as the reference
         # metadata sill intact.
-        self.assertDictContainsSubset(new_body, channel.json_body["content"])
+        self.assertDictContainsSubset(new_body, event_dict["content"])
         self.assertDictContainsSubset(
             {
                 "m.relates_to": {
@@ -653,12 +622,12 @@ class RelationsTestCase(unittest.HomeserverTestCase):
                     "rel_type": "m.reference",
                 }
             },
-            channel.json_body["content"],
+            event_dict["content"],
         )
 
         # We expect that the edit relation appears in the unsigned relations
         # section.
-        relations_dict = channel.json_body["unsigned"].get("m.relations")
+        relations_dict = event_dict["unsigned"].get("m.relations")
         self.assertIn(RelationTypes.REPLACE, relations_dict)
 
         m_replace_dict = relations_dict[RelationTypes.REPLACE]
@@ -688,19 +657,21 @@ class RelationsTestCase(unittest.HomeserverTestCase):
                 "m.new_content": {"msgtype": "m.text", "body": "First edit"},
             },
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
         # Check the relation is returned
         channel = self.make_request(
             "GET",
-            "/_matrix/client/unstable/rooms/%s/relations/%s/m.replace/m.room.message"
-            % (self.room, original_event_id),
+            RELATIONS_URL % (self.room, original_event_id)
+            + "/m.replace/m.room.message",
             access_token=self.user_token,
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
-        self.assertIn("chunk", channel.json_body)
-        self.assertEquals(len(channel.json_body["chunk"]), 1)
+        self.assertIn("chunk", body)
+        self.assertEqual(len(body["chunk"]), 1)
 
         # Redact the original event
         channel = self.make_request(
@@ -710,20 +681,22 @@ class RelationsTestCase(unittest.HomeserverTestCase):
             access_token=self.user_token,
             content="{}",
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
         # Try to check for remaining m.replace relations
         channel = self.make_request(
             "GET",
-            "/_matrix/client/unstable/rooms/%s/relations/%s/m.replace/m.room.message"
-            % (self.room, original_event_id),
+            RELATIONS_URL % (self.room, original_event_id)
+            + "/m.replace/m.room.message",
             access_token=self.user_token,
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
         # Check that no relations are returned
-        self.assertIn("chunk", channel.json_body)
-        self.assertEquals(channel.json_body["chunk"], [])
+        self.assertIn("chunk", body)
+        self.assertEqual(body["chunk"], [])
 
     def test_aggregations_redaction_prevents_access_to_aggregations(self):
         """Test that annotations of an event are redacted when the original event
@@ -737,7 +710,8 @@ class RelationsTestCase(unittest.HomeserverTestCase):
         channel = self._send_relation(
             RelationTypes.ANNOTATION, "m.reaction", key="👍", parent_id=original_event_id
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
         # Redact the original
         channel = self.make_request(
@@ -751,19 +725,21 @@ class RelationsTestCase(unittest.HomeserverTestCase):
             access_token=self.user_token,
             content="{}",
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
         # Check that aggregations returns zero
         channel = self.make_request(
             "GET",
-            "/_matrix/client/unstable/rooms/%s/aggregations/%s/m.annotation/m.reaction"
-            % (self.room, original_event_id),
+            AGGREGATIONS_URL % (self.room, original_event_id)
+            + "/m.annotation/m.reaction",
             access_token=self.user_token,
         )
-        self.assertEquals(200, channel.code, channel.json_body)
+        body = channel.json_body
+        self.assertEqual(200, channel.code, body)
 
-        self.assertIn("chunk", channel.json_body)
-        self.assertEquals(channel.json_body["chunk"], [])
+        self.assertIn("chunk", body)
+        self.assertEqual(body["chunk"], [])
 
     def _send_relation(
         self,
@@ -793,21 +769,155 @@ class RelationsTestCase(unittest.HomeserverTestCase):
 
         query = ""
         if key:
-            query = "?key=" + urllib.parse.quote_plus(key.encode("utf-8"))
+            query = "?key=" + _quote_key(key)
 
         original_id = parent_id if parent_id else self.parent_id
 
         channel = self.make_request(
             "POST",
-            "/_matrix/client/unstable/rooms/%s/send_relation/%s/%s/%s%s"
+            SEND_RELATION_URL
             % (self.room, original_id, relation_type, event_type, query),
             content or {},
             access_token=access_token,
         )
         return channel
 
+    def _paginate_all(self, url: str, limit: int) -> List[JsonDict]:
+        """Page through a relations or aggregations endpoint until there are no
+        more results.
+
+        Args:
+            url: The endpoint to paginate, without any query parameters.
+            limit: The number of results to request per page.
+
+        Returns:
+            The entries of every returned chunk, in the order they were returned.
+        """
+        first_page = "%s?limit=%d" % (url, limit)
+
+        prev_token: Optional[str] = None
+        results: List[JsonDict] = []
+        for _ in range(20):
+            path = first_page
+            if prev_token:
+                path = "%s&from=%s" % (first_page, prev_token)
+
+            channel = self.make_request("GET", path, access_token=self.user_token)
+            # `json_body` re-parses the response on every access, so only do so once.
+            body = channel.json_body
+            self.assertEqual(200, channel.code, body)
+
+            chunk = body["chunk"]
+            results.extend(chunk)
+            next_batch = body.get("next_batch")
+
+            # Only the last page may be short.
+            if next_batch:
+                self.assertEqual(len(chunk), limit, body)
+
+            self.assertNotEqual(prev_token, next_batch)
+            prev_token = next_batch
+
+            if not prev_token:
+                break
+
+        return results
+
+    def _inject_relation(
+        self,
+        relation_type: str,
+        event_type: str,
+        key: Optional[str] = None,
+        sender: Optional[str] = None,
+    ) -> str:
+        """Helper function to persist a relation pointing at `self.parent_id`
+        directly, rather than sending it via the client API.
+
+        Args:
+            relation_type: One of `RelationTypes`
+            event_type: The type of the event to create
+            key: The aggregation key used for m.annotation relation type.
+            sender: The user sending the relation, defaults to `self.user_id`
+
+        Returns:
+            The event ID of the new event.
+        """
+        relates_to = {"event_id": self.parent_id, "rel_type": relation_type}
+        if key:
+            relates_to["key"] = key
+
+        event = self.get_success(
+            event_injection.inject_event(
+                self.hs,
+                room_id=self.room,
+                type=event_type,
+                sender=sender or self.user_id,
+                content={"m.relates_to": relates_to},
+            )
+        )
+        return event.event_id
+
+    def _get_event_direct(self, event_id: str) -> JsonDict:
+        """Fetch an event from the store and serialize it for clients, with any
+        aggregations bundled in.
+
+        This skips the HTTP layer for tests which only care about the contents
+        of the serialized event; `test_send_relation` covers the /event API.
+
+        Args:
+            event_id: The event to fetch.
+
+        Returns:
+            The serialized event.
+        """
+        event = self.get_success(self.hs.get_datastore().get_event(event_id))
+        return self.get_success(
+            self.hs.get_event_client_serializer().serialize_event(
+                event, self.clock.time_msec()
+            )
+        )
+
     def _create_user(self, localpart: str) -> Tuple[str, str]:
         user_id = self.register_user(localpart, "abc123")
-        access_token = self.login(localpart, "abc123")
+
+        # Mint the access token directly, rather than going through a /login
+        # round-trip and password check for every user.
+        access_token = self.get_success(
+            self.hs.get_auth_handler().create_access_token_for_user_id(
+                user_id, device_id=None, valid_until_ms=None
+            )
+        )
 
         return user_id, access_token
+
+    def _create_room_members(self, count: int) -> List[str]:
+        """Create some new users and join them to `self.room`.
+
+        Args:
+            count: The number of users to create.
+
+        Returns:
+            The access tokens of the new users.
+        """
+        access_tokens = []
+        for idx in range(count):
+            user_id, token = self._create_user("test" + str(idx))
+            self._join_room(user_id)
+            access_tokens.append(token)
+
+        return access_tokens
+
+    def _join_room(self, user_id: str) -> None:
+        """Join a user to `self.room`.
+
+        Joining is only test setup here, so the membership event is injected
+        directly rather than sent through the client API.
+
+        Args:
+            user_id: The user to join to the room.
+        """
+        self.get_success(
+            event_injection.inject_member_event(
+                self.hs, self.room, user_id, Membership.JOIN
+            )
+        )